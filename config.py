@@ -6,6 +6,14 @@ from threading import Thread
 DEFAULT_DOWNLOAD_PATH = "./download/"
 DOWNLOAD_THREAD_NUM = 8
 SLEEP_SECONDS_BETWEEN_BATCH = 3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PIXIV_META_CONCURRENCY = 8
+PARSER_CONNECTION_LIMIT = 16
+DNS_CACHE_SECONDS = 300
+COOKIE_CACHE_SECONDS = 300
+# a stalled download gives up its slot after this long without receiving data
+DOWNLOAD_CONNECT_TIMEOUT_SECONDS = 30
+DOWNLOAD_READ_TIMEOUT_SECONDS = 60
 
 
 def start_loop(loop):
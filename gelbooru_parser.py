@@ -1,20 +1,19 @@
 import re
 
-import aiohttp
 from bs4 import BeautifulSoup, NavigableString
 
-from utils import Downloader, DownloadDataEntry
+from utils import DOWNLOADER, DownloadDataEntry, get_parser_session
 from config import PROXY
 
 
 async def parse_gelbooru(url):
     print(f"parsing {url}")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, proxy=PROXY) as response:
-            if response.status != 200:
-                raise Exception(url + " " + str(response.status))
-            html = await response.text()
+    session = await get_parser_session()
+    async with session.get(url, proxy=PROXY) as response:
+        if response.status != 200:
+            raise Exception(url + " " + str(response.status))
+        html = await response.text()
 
     soup = BeautifulSoup(html, features="html.parser")
     print(f"parsed {url}")
@@ -68,7 +67,7 @@ async def parse_gelbooru(url):
         if "Source" in post_attr_elements_dict["statistics"] else "unknown"
     illust_code = post_attr_elements_dict["statistics"]["Id"]
     media_url = post_attr_elements_dict["media_url"]
-    media_format = media_url.rsplit(".", 1)[-1]
+    media_format = media_url.rpartition(".")[2]
 
     source = source.replace(
         "https://", "").replace("http://", "").replace("www.", "")
@@ -81,5 +80,5 @@ async def parse_gelbooru(url):
     else:
         source = source.replace("/", "_")
 
-    await Downloader.get_downloader().submit_download_requests(
+    await DOWNLOADER.submit_download_requests(
         [DownloadDataEntry(media_url, f"gelbooru_{illust_code}_{artist}_{source}.{media_format}")], url)
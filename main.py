@@ -8,7 +8,8 @@ from danbooru_parser import parse_danbooru
 from gelbooru_parser import parse_gelbooru
 from parse_exception import ParseException
 from pixiv_parser import parse_pixiv
-from twitter_parser import parse_twitter
+from twitter_parser import parse_twitter, shutdown_twitter
+from utils import DOWNLOADER, close_parser_session
 from yandere_parser import parse_yandere
 
 _failed = []
@@ -78,7 +79,10 @@ if __name__ == '__main__':
     tasks = [asyncio.ensure_future(downloader(url, want_index_tp)) for url, want_index_tp in url_ls]
     new_loop.run_until_complete(asyncio.wait(tasks))
     new_loop.run_until_complete(wait_loop_end())
+    new_loop.run_until_complete(shutdown_twitter())
+    new_loop.run_until_complete(close_parser_session())
 
+    asyncio.run_coroutine_threadsafe(DOWNLOADER.aclose(), config.COROUTINE_THREAD_LOOP).result()
     config.COROUTINE_THREAD_LOOP.call_soon_threadsafe(config.COROUTINE_THREAD_LOOP.stop)
 
     if _failed:
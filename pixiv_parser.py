@@ -1,18 +1,29 @@
-import json
+import asyncio
 import re
-import urllib.parse
-from weakref import proxy
-
-import aiohttp
 
 from parse_exception import ParseException
-from utils import Downloader, DownloadDataEntry
-from config import PROXY, PIXIV_HEADER
+from utils import DOWNLOADER, DownloadDataEntry, json_loads, get_parser_session
+from config import PROXY, PIXIV_HEADER, PIXIV_META_CONCURRENCY
 
 
 def get_file_name_without_suffix(illust_code, illust_code_in_page, file_format):
     return f"pixiv_{illust_code}_p{illust_code_in_page}.{file_format}"
 
+
+# many queued artworks would otherwise hit the ajax api all at once
+_illust_meta_semaphore = asyncio.Semaphore(PIXIV_META_CONCURRENCY)
+
+
+async def fetch_illust_meta(url):
+    async with _illust_meta_semaphore:
+        session = await get_parser_session()
+        async with session.get(url, proxy=PROXY, headers=PIXIV_HEADER) as response:
+            if response.status != 200:
+                raise Exception(url + " " + str(response.status))
+            raw_data = await response.read()
+    return json_loads(raw_data)
+
+
 async def parse_pixiv(url, save_img_index_ls=None):
     print(f"parsing {url}")
     if save_img_index_ls is None:
@@ -20,14 +31,9 @@ async def parse_pixiv(url, save_img_index_ls=None):
     illust_code = re.search(
         r"https?://www.pixiv.net/artworks/(\d+)", url).group(1)
 
-    async with aiohttp.ClientSession() as session:
-        url = f"https://www.pixiv.net/ajax/illust/{illust_code}?lang=zh"
-        async with session.get(url, proxy=PROXY,headers =PIXIV_HEADER) as response:
-            if response.status != 200:
-                raise Exception(url + " " + str(response.status))
-            html = await response.text()
-            raw_data = json.loads(html)
-            first_illust_url = raw_data['body']['urls']['original']
+    url = f"https://www.pixiv.net/ajax/illust/{illust_code}?lang=zh"
+    raw_data = await fetch_illust_meta(url)
+    first_illust_url = raw_data['body']['urls']['original']
     print(f"parsed {url}")
 
     if not first_illust_url:
@@ -38,11 +44,13 @@ async def parse_pixiv(url, save_img_index_ls=None):
     illust_url_prefix, illust_url_suffix = first_illust_url.rsplit("0", 1)
 
     header = {"Referer": "https://www.pixiv.net/"}
+    # every page shares the same name prefix and, apart from the page index, the same url
+    file_name_prefix = f"pixiv_{illust_code}_p"
+    file_format = illust_url_suffix.rpartition(".")[2]
     download_entry_ls = []
     for illust_code_in_page in save_img_index_ls:
         image_url = illust_url_prefix + \
                     str(illust_code_in_page) + illust_url_suffix
-        file_format = image_url.rsplit(".", 1)[1]
         download_entry_ls.append(
-            DownloadDataEntry(image_url, get_file_name_without_suffix(illust_code, illust_code_in_page, file_format)))
-    await Downloader.get_downloader().submit_download_requests(download_entry_ls, url, header=header)
+            DownloadDataEntry(image_url, f"{file_name_prefix}{illust_code_in_page}.{file_format}"))
+    await DOWNLOADER.submit_download_requests(download_entry_ls, url, header=header)
@@ -1,60 +1,111 @@
 import asyncio
-import pprint
-import re
 import time
-from http.cookiejar import Cookie
-from typing import Dict, List
-from weakref import proxy
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
 
 from pyppeteer import launch
+from pyppeteer.browser import Browser
 from pyppeteer.network_manager import Response
-import browsercookie
 
 from cookie_parser import parse_cookie_from_export_cookie_file_plugin
 from parse_exception import ParseException
-from utils import Downloader, DownloadDataEntry, pyppeteer_request_debug, pyppeteer_response_debug
-from config import PROXY
+from utils import DOWNLOADER, DownloadDataEntry, json_loads
+from config import PROXY, COOKIE_CACHE_SECONDS
 
 
-def extract_pic_download_entry(data_pack, save_index_in_post, post_author, post_code):
-    media_url_https = data_pack['media_url_https'] + "?name=4096x4096"
-    file_format = data_pack['media_url_https'].rsplit(".", 1)[1]
-    return DownloadDataEntry(
-        media_url_https,
-        f"{get_file_name_without_suffix(save_index_in_post, post_author, post_code)}.{file_format}"
-    )
+def extract_pic_download_entry(data_pack, save_index_in_post, name_prefix):
+    media_url = data_pack['media_url_https']
+    media_url_https = media_url + "?name=4096x4096"
+    file_format = media_url.rpartition(".")[2]
+    return DownloadDataEntry(media_url_https, f"{name_prefix}{save_index_in_post}.{file_format}")
 
 
-def extract_video_download_entry(data_pack, save_index_in_post, post_author, post_code):
-    video_variants = list(filter(
-        lambda x: x['content_type'] == "video/mp4", data_pack['video_info']['variants']))
-    media_url_https = max(video_variants, key=lambda x: x['bitrate'])[
-        'url'].rsplit("?", 1)[0]
-    file_format = media_url_https.rsplit(".", 1)[1]
-    return DownloadDataEntry(
-        media_url_https,
-        f"{get_file_name_without_suffix(save_index_in_post, post_author, post_code)}.{file_format}"
-    )
+def extract_video_download_entry(data_pack, save_index_in_post, name_prefix):
+    best_bitrate, best_url = -1, None
+    for variant in data_pack['video_info']['variants']:
+        if variant['content_type'] == "video/mp4" and variant['bitrate'] > best_bitrate:
+            best_bitrate, best_url = variant['bitrate'], variant['url']
+    media_url_https = best_url.partition("?")[0]
+    file_format = media_url_https.rpartition(".")[2]
+    return DownloadDataEntry(media_url_https, f"{name_prefix}{save_index_in_post}.{file_format}")
 
 
-def get_file_name_without_suffix(save_index_in_post, post_author, post_code):
-    return f"twitter_{post_author}_{post_code}_{save_index_in_post}"
+def get_file_name_prefix(post_author, post_code):
+    return f"twitter_{post_author}_{post_code}_"
 
 
-def cookie_to_pyppeteer_ver(cookie: dict) -> Dict:
+def cookie_to_pyppeteer_ver(cookie: dict, expires: int) -> Dict:
     # return cookie
     return {
         'name': cookie.get('name'),
         'value': cookie.get('value'),
         'domain': cookie.get('domain'),
         'path': cookie.get('path'),
-        'expires': int(time.time() + 3600),
+        'expires': expires,
         'httpOnly': True,
         'secure': True,
         'sameSite': 'Lax'
     }
 
 
+# the cookie file does not change during a batch, so it is re-read at most every COOKIE_CACHE_SECONDS
+_cached_cookies: Optional[List[Dict]] = None
+_cached_cookies_time = 0.0
+
+
+def get_pyppeteer_cookies() -> List[Dict]:
+    global _cached_cookies, _cached_cookies_time
+    now = time.time()
+    if _cached_cookies is None or now - _cached_cookies_time > COOKIE_CACHE_SECONDS:
+        edge_cookies = parse_cookie_from_export_cookie_file_plugin()
+        cookie_expires = int(now + 3600)
+        _cached_cookies = [cookie_to_pyppeteer_ver(cookie, cookie_expires) for cookie in edge_cookies]
+        _cached_cookies_time = now
+    return _cached_cookies
+
+
+def clear_cookie_cache():
+    global _cached_cookies
+    _cached_cookies = None
+
+
+# launching chromium takes seconds, so one browser is shared by every parse_twitter call
+_browser: Optional[Browser] = None
+_browser_lock = asyncio.Lock()
+
+
+async def get_browser() -> Browser:
+    global _browser
+    async with _browser_lock:
+        # chromium may have crashed or been closed by hand since the last call
+        if _browser is None or _browser.process.poll() is not None:
+            if PROXY:
+                _browser = await launch({'args': [f'--proxy-server={PROXY}', '--ignore-certificate-errors'],
+                                         'headless': False})
+            else:
+                _browser = await launch({'args': ['--ignore-certificate-errors'], 'headless': False})
+        return _browser
+
+
+async def shutdown_twitter():
+    global _browser
+    async with _browser_lock:
+        if _browser is not None:
+            await _browser.close()
+            _browser = None
+
+
+def find_tweet_results(instructions: List[dict]) -> dict:
+    # a missing entry is reported as KeyError, like any other missing field of the response
+    for instruction in instructions:
+        if instruction.get('type') == "TimelineAddEntries":
+            for entry in instruction['entries']:
+                if entry['entryId'].startswith("tweet-"):
+                    return entry['content']['itemContent']['tweet_results']
+            break
+    raise KeyError("tweet-")
+
+
 def response_filter(response: Response) -> bool:
     # print(f"{response.request.method} {response.status} {response.url}")
     return "TweetDetail" in response.url and response.request.method == "GET" and response.status==200
@@ -63,63 +114,53 @@ async def parse_twitter(url, save_img_index_ls=None):
     print(f"parsing {url}")
     if save_img_index_ls is None:
         save_img_index_ls = [1]
-    post_url_search_res = re.search(
-        r"https://[^.]+.com/([^/]+)/status/(\d+)", url)
-    post_author = post_url_search_res.group(1)
-    post_code = post_url_search_res.group(2)
-
-    # print("waiting launch")
-    if PROXY:
-        browser = await launch({'args': [f'--proxy-server={PROXY}', '--ignore-certificate-errors'], 'headless': False})
-    else:
-        browser = await launch({'args': ['--ignore-certificate-errors'], 'headless': False})
-    # browser = await launch(
-    #     devtools=True,
-    #     headless=False,
-    #     args=['--no-sandbox'],
-    #     autoClose=False
-    # )
+    # ['', author, 'status', code, ...]
+    path_parts = urlsplit(url).path.split("/")
+    if len(path_parts) < 4 or path_parts[2] != "status" or not path_parts[3].isdigit():
+        raise ParseException("Unrecognized tweet url", url, [])
+    post_author, post_code = path_parts[1], path_parts[3]
+    name_prefix = get_file_name_prefix(post_author, post_code)
+
+    # load the cookies first, so a missing cookie file doesn't leave a page open
+    twitter_cookies = get_pyppeteer_cookies()
+    browser = await get_browser()
     # print("waiting newPage")
     page = await browser.newPage()
-    # await page.goto('https://github.com/login')
-    # await page.type('#login_field', 'laurence042')  # your user name here
-    # await page.type('#password', 'Un4080210185')  # your password here
-    # navPromise = asyncio.ensure_future(page.waitForNavigation())
-    # await page.click('input[type=submit]')
-    # await navPromise
-    # cookies = await page.cookies()
-    # await browser.close()
-
-    # print("waiting Response")
-    # edge_cookies = browsercookie.edge()
-    edge_cookies = parse_cookie_from_export_cookie_file_plugin()
-    twitter_cookies = list(
-        map(cookie_to_pyppeteer_ver, edge_cookies))
-    await page.setCookie(*twitter_cookies)
-
-    # graphql api use 'option' as request method first, then use 'get' method to get response.
-    # capture the 'get' response as data
-    response, _ = await asyncio.gather(page.waitForResponse(response_filter),
-                                       page.goto(url))
-    response_data:dict = await response.json()
+    try:
+        # await page.goto('https://github.com/login')
+        # await page.type('#login_field', 'laurence042')  # your user name here
+        # await page.type('#password', 'Un4080210185')  # your password here
+        # navPromise = asyncio.ensure_future(page.waitForNavigation())
+        # await page.click('input[type=submit]')
+        # await navPromise
+        # cookies = await page.cookies()
+        # await browser.close()
+
+        # print("waiting Response")
+        await page.setCookie(*twitter_cookies)
+
+        # graphql api use 'option' as request method first, then use 'get' method to get response.
+        # capture the 'get' response as data
+        response, _ = await asyncio.gather(page.waitForResponse(response_filter),
+                                           page.goto(url))
+        response_data:dict = json_loads(await response.text())
+    finally:
+        await page.close()
     print(f"parsed {url}")
-    await page.close()
 
     core_data:dict = response_data['data']
 
     try:
         if "tweetResult" in core_data:
-            core_data = core_data['tweetResult']
+            tweet_results = core_data['tweetResult']
         else:
-            core_data: list = core_data['threaded_conversation_with_injections_v2']['instructions']
-            core_data = next(item for item in core_data if item["type"] == "TimelineAddEntries")['entries']
-            core_data: dict = next(item for item in core_data if item['entryId'].startswith("tweet-"))[
-                'content']['itemContent']['tweet_results']
-        raw_data_pack = core_data['result']['legacy']
+            tweet_results = find_tweet_results(core_data['threaded_conversation_with_injections_v2']['instructions'])
+        raw_data_pack = tweet_results['result']['legacy']
     except KeyError as e:
+        # the cookie file may have been re-exported with a fresh login
+        clear_cookie_cache()
         raise ParseException("Adult content, login needed", url,
-                             [get_file_name_without_suffix(save_index_in_post, post_author, post_code) for
-                              save_index_in_post in save_img_index_ls])
+                             [f"{name_prefix}{save_index_in_post}" for save_index_in_post in save_img_index_ls])
 
     raw_data_pack: dict = raw_data_pack['extended_entities'] if 'extended_entities' in raw_data_pack else raw_data_pack[
         'entities']
@@ -132,14 +173,14 @@ async def parse_twitter(url, save_img_index_ls=None):
     for save_img_index, data in raw_target_media_data_ls:
         if data['type'] == "photo":
             download_entry_ls.append(extract_pic_download_entry(
-                data, save_img_index, post_author, post_code))
+                data, save_img_index, name_prefix))
         elif data['type'] == "video" or data['type'] == "animated_gif":
             download_entry_ls.append(extract_video_download_entry(
-                data, save_img_index, post_author, post_code))
+                data, save_img_index, name_prefix))
         else:
             print(f"unknown type {data['type']} of url {url}")
 
-    await Downloader.get_downloader().submit_download_requests(download_entry_ls, url)
+    await DOWNLOADER.submit_download_requests(download_entry_ls, url)
     # await page.goto(url)
     # print("waiting json")
     # core_data = await core_response.buffer()
@@ -1,12 +1,40 @@
 import asyncio
+import contextlib
 import os
-from asyncio import sleep
-from typing import List, Dict
+import threading
+from typing import List, Dict, Optional
 
+import aiofiles
 import aiohttp
 from pyppeteer.network_manager import Response, Request
 
-from config import DEFAULT_DOWNLOAD_PATH, DOWNLOAD_THREAD_NUM, COROUTINE_THREAD_LOOP, SLEEP_SECONDS_BETWEEN_BATCH, PROXY
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from config import DEFAULT_DOWNLOAD_PATH, DOWNLOAD_THREAD_NUM, COROUTINE_THREAD_LOOP, PROXY, DOWNLOAD_CHUNK_SIZE, \
+    DOWNLOAD_CONNECT_TIMEOUT_SECONDS, DOWNLOAD_READ_TIMEOUT_SECONDS, PARSER_CONNECTION_LIMIT, DNS_CACHE_SECONDS
+
+
+# parsers run on the main loop and share this session, so page fetches reuse pooled connections
+_parser_session: Optional[aiohttp.ClientSession] = None
+
+
+async def get_parser_session() -> aiohttp.ClientSession:
+    global _parser_session
+    if _parser_session is None or _parser_session.closed:
+        # no cookie jar: each request only sends the cookies in its own headers, like a fresh session did
+        connector = aiohttp.TCPConnector(limit=PARSER_CONNECTION_LIMIT, ttl_dns_cache=DNS_CACHE_SECONDS)
+        _parser_session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+    return _parser_session
+
+
+async def close_parser_session():
+    global _parser_session
+    if _parser_session is not None:
+        await _parser_session.close()
+        _parser_session = None
 
 
 class DownloadDataEntry:
@@ -24,70 +52,130 @@ class DownloadDataEntry:
         return f"url:{self.url},file_path:{self.file_path}"
 
 
+class TagCounter:
+    # downloads of one tag finish on the coroutine thread, so the count is guarded by a lock.
+    # "finished" is only touched by submit_download_requests, on the loop that submitted the tag
+    __slots__ = ("done", "total", "lock", "finished")
+
+    def __init__(self, total):
+        self.done = 0
+        self.total = total
+        self.lock = threading.Lock()
+        self.finished = asyncio.Event()
+
+
 class Downloader:
     thread_num = DOWNLOAD_THREAD_NUM
 
-    tag_counter_dict = {}
+    tag_counter_dict: Dict[str, TagCounter] = {}
 
     instance = None
 
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
     @classmethod
     def get_downloader(cls):
         if not Downloader.instance:
             Downloader.instance = Downloader()
         return Downloader.instance
 
+    def get_session(self) -> aiohttp.ClientSession:
+        # created on first download so it is bound to COROUTINE_THREAD_LOOP, where all downloads run
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.thread_num * 4, limit_per_host=self.thread_num,
+                                             ttl_dns_cache=DNS_CACHE_SECONDS)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=DOWNLOAD_CONNECT_TIMEOUT_SECONDS,
+                                            sock_read=DOWNLOAD_READ_TIMEOUT_SECONDS)
+            # like the parser session, no cookies carry over from one download to the next
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                  cookie_jar=aiohttp.DummyCookieJar())
+        return self._session
+
+    def get_semaphore(self) -> asyncio.Semaphore:
+        # like the session, it must be created on COROUTINE_THREAD_LOOP
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.thread_num)
+        return self._semaphore
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     async def submit_download_requests(self, requests_ls: List[DownloadDataEntry], tag: str, sub_dir_name="",
                                        header=None):
         file_save_dir = os.path.join(DEFAULT_DOWNLOAD_PATH, sub_dir_name)
         if not os.path.exists(file_save_dir):
             os.makedirs(file_save_dir)
 
-        while self.tag_counter_dict.get(tag) is not None:
-            await sleep(SLEEP_SECONDS_BETWEEN_BATCH)
-        self.tag_counter_dict[tag] = (0, len(requests_ls))
+        while (previous_counter := self.tag_counter_dict.get(tag)) is not None:
+            await previous_counter.finished.wait()
+        tag_counter = TagCounter(len(requests_ls))
+        self.tag_counter_dict[tag] = tag_counter
 
         for request in requests_ls:
             full_file_path = os.path.join(file_save_dir, request.file_path)
             request.file_path = full_file_path
 
-        while len(requests_ls) > 0:
-            request_batch = requests_ls[:self.thread_num]
-            requests_ls = requests_ls[self.thread_num:]
-            for request in request_batch:
-                # print(request, tag)
-                asyncio.run_coroutine_threadsafe(self.download_pic(
-                    request, tag, header), COROUTINE_THREAD_LOOP)
-            await sleep(SLEEP_SECONDS_BETWEEN_BATCH)
+        # concurrency is capped by the semaphore in download_pic, so everything is submitted at once
+        download_futures = [asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            self.download_pic(request, tag, header), COROUTINE_THREAD_LOOP)) for request in requests_ls]
+        try:
+            results = await asyncio.gather(*download_futures, return_exceptions=True)
+        finally:
+            del self.tag_counter_dict[tag]
+            tag_counter.finished.set()
+
+        failed_cnt = 0
+        for request, result in zip(requests_ls, results):
+            if isinstance(result, BaseException):
+                failed_cnt += 1
+                print(f"\033[31mdownload failed\033[0m:{request.url} {result}")
+        if failed_cnt:
+            raise Exception(f"{failed_cnt}/{len(requests_ls)} downloads failed tag:{tag}")
 
     async def download_pic(self, download_request: DownloadDataEntry, tag: str, header: Dict[str, str]):
-        if os.path.exists(download_request.file_path) and os.path.getsize(download_request.file_path) > 0:
-            self.tag_counter_dict[tag] = (
-                self.tag_counter_dict[tag][0] + 1, self.tag_counter_dict[tag][1])
-            if self.tag_counter_dict[tag][0] == self.tag_counter_dict[tag][1]:
-                del self.tag_counter_dict[tag]
-            print(
-                f"{download_request.url} exist tag:{tag} {self.tag_counter_dict[tag][0]}/{self.tag_counter_dict[tag][1]}")
+        try:
+            file_exists = os.stat(download_request.file_path).st_size > 0
+        except OSError:
+            file_exists = False
+        if file_exists:
+            done, total = self.count_finished(tag)
+            print(f"{download_request.url} exist tag:{tag} {done}/{total}")
             return
 
-        async with aiohttp.ClientSession(headers=header) as session:
-            response = await session.get(download_request.url, proxy=PROXY)
-            if response.status != 200:
-                raise Exception(download_request.url +
-                                " " + str(response.status))
-            content = await response.read()
-
-        with open(download_request.file_path, 'wb') as f:
-            f.write(content)
+        # stream into a ".part" file so a broken download never passes the size check above
+        part_file_path = download_request.file_path + ".part"
+        async with self.get_semaphore():
+            async with self.get_session().get(download_request.url, headers=header, proxy=PROXY) as response:
+                if response.status != 200:
+                    raise Exception(download_request.url +
+                                    " " + str(response.status))
+                try:
+                    async with aiofiles.open(part_file_path, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            await f.write(chunk)
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(part_file_path)
+                    raise
+        os.replace(part_file_path, download_request.file_path)
+
+        done, total = self.count_finished(tag)
+        print(f"{download_request.url} ok tag:{tag} {done}/{total}")
+
+    def count_finished(self, tag: str):
+        counter = self.tag_counter_dict[tag]
+        with counter.lock:
+            counter.done += 1
+            done, total = counter.done, counter.total
+        return done, total
+
+
+DOWNLOADER = Downloader.get_downloader()
 
-        download_status = self.tag_counter_dict[tag]
-        new_download_status = (download_status[0] + 1, download_status[1])
-        if new_download_status[0] == new_download_status[1]:
-            del self.tag_counter_dict[tag]
-        else:
-            self.tag_counter_dict[tag] = new_download_status
-        print(
-            f"{download_request.url} ok tag:{tag} {new_download_status[0]}/{new_download_status[1]}")
 
 async def pyppeteer_request_debug(request:Request):
     # Response logic goes here
@@ -1,35 +1,43 @@
 import re
 from weakref import proxy
 
-import aiohttp
 from bs4 import BeautifulSoup, NavigableString
 
-from utils import Downloader, DownloadDataEntry
+from utils import DOWNLOADER, DownloadDataEntry, get_parser_session
 from config import PROXY
 
+_TWITTER_SRC_RE = re.compile(r"twitter.com/([^/]+)/status/(\d+)")
+
 
 async def parse_yandere(url):
     print(f"parsing {url}")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, proxy=PROXY) as response:
-            if response.status != 200:
-                raise Exception(url + " " + str(response.status))
-            html = await response.text()
+    session = await get_parser_session()
+    async with session.get(url, proxy=PROXY) as response:
+        if response.status != 200:
+            raise Exception(url + " " + str(response.status))
+        html = await response.text()
 
-    soup = BeautifulSoup(html, features="html.parser")
+    soup = BeautifulSoup(html, features="lxml")
     print(f"parsed {url}")
 
     tag_sidebar = soup.find("ul", id="tag-sidebar")
     stats_sidebar = soup.find("div", id="stats").find("ul")
     high_res_link = soup.find("a", id="highres")
 
-    artist_tag_elements = tag_sidebar.findAll("li", class_="tag-type-artist")
-    copyright_tag_elements = tag_sidebar.findAll(
-        "li", class_="tag-type-copyright")
-    character_tag_elements = tag_sidebar.findAll(
-        "li", class_="tag-type-character")
-    general_tag_elements = tag_sidebar.findAll("li", class_="tag-type-general")
+    # walk the sidebar once and bucket every entry by its "tag-type-*" class
+    tag_elements_by_type = {"artist": [], "copyright": [], "character": [], "general": []}
+    for tag_element in tag_sidebar.find_all("li"):
+        for class_name in tag_element.get("class") or ():
+            if class_name.startswith("tag-type-"):
+                tag_type = class_name[len("tag-type-"):]
+                if tag_type in tag_elements_by_type:
+                    tag_elements_by_type[tag_type].append(tag_element)
+                break
+    artist_tag_elements = tag_elements_by_type["artist"]
+    copyright_tag_elements = tag_elements_by_type["copyright"]
+    character_tag_elements = tag_elements_by_type["character"]
+    general_tag_elements = tag_elements_by_type["general"]
 
     stats_elements = stats_sidebar.findAll("li")
 
@@ -40,11 +48,10 @@ async def parse_yandere(url):
                                         "tag_cnt": entry_elements[2].text}
 
     def statistics_element_parser(entry_elements):
-        text = "".join((map(lambda x: x.text, entry_elements)))
-        if text.startswith("Source"):
+        k, _, v = entry_elements.get_text().partition(":")
+        if k.startswith("Source"):
             return "Source", entry_elements.contents[1].attrs["href"]
-        k, v = re.split(r":\s*", text, 1)
-        return k, v
+        return k, v.lstrip()
 
     tags_name_ls = ["Artist", "Copyright", "Tag"]
     tags_ls = [artist_tag_elements, copyright_tag_elements,
@@ -66,18 +73,17 @@ async def parse_yandere(url):
         if "Source" in post_attr_elements_dict["statistics"] else "unknown"
     illust_code = post_attr_elements_dict["statistics"]["Id"]
     media_url = post_attr_elements_dict["media_url"]
-    media_format = media_url.rsplit(".", 1)[-1]
+    media_format = media_url.rpartition(".")[2]
 
     source = source.replace(
         "https://", "").replace("http://", "").replace("www.", "")
     if source.startswith("pixiv.net"):
         source = "pixiv_" + source.rsplit("/", 1)[-1]
     elif source.startswith("twitter.com"):
-        twitter_username, twitter_post_id = re.search(
-            r"twitter.com/([^/]+)/status/(\d+)", source).groups()
+        twitter_username, twitter_post_id = _TWITTER_SRC_RE.search(source).groups()
         source = f"twitter_{twitter_username}_{twitter_post_id}"
     else:
         source = source.replace("/", "_")
 
-    await Downloader.get_downloader().submit_download_requests(
+    await DOWNLOADER.submit_download_requests(
         [DownloadDataEntry(media_url, f"yandere_{illust_code}_{artist}_{source}.{media_format}")], url)